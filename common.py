@@ -1,35 +1,268 @@
-from typing import Optional
+import asyncio
+import atexit
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Optional,
+    Sized,
+    TypeVar,
+)
 
 import httpx
-from bs4 import BeautifulSoup
+import orjson
+from bs4 import BeautifulSoup, SoupStrainer
 from httpx import AsyncClient, Limits
+from tqdm.asyncio import tqdm
+
+T = TypeVar("T")
 
-httpxClient = AsyncClient(limits=Limits(max_connections=10))
-httpxClient.headers.update(
-    {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-    }
+httpxClient = AsyncClient(
+    http2=True,
+    headers={
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3",
+        "Accept-Encoding": "gzip, br",
+    },
+    limits=Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=httpx.Timeout(30.0, connect=10.0),
+    follow_redirects=True,
 )
 
+isbnCache: dict[str, str] = {}
+isbnCachePath: Optional[Path] = None
+isbnCacheFlushSeconds = 30.0
+
+maxConcurrentRequests = 32
+requestSemaphore = asyncio.Semaphore(maxConcurrentRequests)
+
+maxWorkers = 32
+
+maxRetries = 5
+retryBackoffSeconds = 1.0
+idempotentMethods = {"GET", "HEAD"}
+idempotentRetryStatusCodes = {
+    httpx.codes.INTERNAL_SERVER_ERROR,
+    httpx.codes.BAD_GATEWAY,
+    httpx.codes.SERVICE_UNAVAILABLE,
+    httpx.codes.GATEWAY_TIMEOUT,
+}
+
+isbnMetaPatterns = [
+    re.compile(
+        rb"<meta[^>]+property=[\"']books:isbn[\"'][^>]+content=[\"']([^\"']+)[\"']"
+    ),
+    re.compile(
+        rb"<meta[^>]+content=[\"']([^\"']+)[\"'][^>]+property=[\"']books:isbn[\"']"
+    ),
+]
+isbnMetaMaxLength = 512
+isbnSeparators = str.maketrans("", "", "- ")
+isbnMetaStrainer = SoupStrainer("meta", {"property": "books:isbn"})
+
 
 def normalizeIsbn(isbn: str) -> str:
-    return isbn.replace("-", "").replace(" ", "").strip()
+    return isbn.translate(isbnSeparators).strip()
 
 
-async def getBookIsbn(url: str) -> Optional[str]:
-    response = await httpxClient.get(url)
-    if response.status_code == httpx.codes.NOT_FOUND:
-        return None
-    response.raise_for_status()
-    soup = BeautifulSoup(response.text, "html.parser")
-    isbnTag = soup.find("meta", {"property": "books:isbn"})
+def loadIsbnCache(outputDirectory: Path):
+    global isbnCachePath
+    isbnCachePath = outputDirectory / "isbn_cache.json"
+    if isbnCachePath.exists():
+        try:
+            isbnCache.update(orjson.loads(isbnCachePath.read_bytes()))
+        except orjson.JSONDecodeError:
+            print(f"Ignoring unreadable ISBN cache: {isbnCachePath}")
+
+
+@atexit.register
+def saveIsbnCache():
+    if isbnCachePath is not None:
+        partialPath = isbnCachePath.with_suffix(".json.part")
+        partialPath.write_bytes(orjson.dumps(isbnCache))
+        os.replace(partialPath, isbnCachePath)
+
+
+def shouldRetry(method: str, response: httpx.Response) -> bool:
+    if response.status_code == httpx.codes.TOO_MANY_REQUESTS:
+        return True
+    return (
+        method.upper() in idempotentMethods
+        and response.status_code in idempotentRetryStatusCodes
+    )
+
+
+def retryDelay(response: httpx.Response, attempt: int) -> float:
+    retryAfter = response.headers.get("Retry-After")
+    if retryAfter is not None:
+        if retryAfter.isdigit():
+            return float(retryAfter)
+        try:
+            retryAt = parsedate_to_datetime(retryAfter)
+            return max(0.0, (retryAt - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    return retryBackoffSeconds * 2**attempt
+
+
+async def sendRequest(method: str, url: str, **kwargs) -> httpx.Response:
+    for attempt in range(maxRetries):
+        async with requestSemaphore:
+            response = await httpxClient.request(method, url, **kwargs)
+        if not shouldRetry(method, response):
+            return response
+        await asyncio.sleep(retryDelay(response, attempt))
+    async with requestSemaphore:
+        return await httpxClient.request(method, url, **kwargs)
+
+
+async def warmUpConnections(*urls: str):
+    async def _warmUp(url: str):
+        try:
+            await httpxClient.head(url)
+        except httpx.HTTPError:
+            pass
+
+    await asyncio.gather(*[_warmUp(url) for url in urls])
+
+
+@asynccontextmanager
+async def streamRequest(
+    method: str, url: str, **kwargs
+) -> AsyncIterator[httpx.Response]:
+    async with requestSemaphore, httpxClient.stream(method, url, **kwargs) as response:
+        yield response
+
+
+def findIsbnMeta(content: bytes, start: int = 0) -> Optional[str]:
+    for pattern in isbnMetaPatterns:
+        match = pattern.search(content, start)
+        if match is not None:
+            return match.group(1).decode()
+    return None
+
+
+def parseIsbnMeta(content: bytes) -> Optional[str]:
+    soup = BeautifulSoup(content, "lxml", parse_only=isbnMetaStrainer)
+    isbnTag = soup.meta
     if isbnTag is not None:
-        isbn = isbnTag["content"]
-        if isbn in ["000-00-0000-00-0"]:
-            return None
-        return normalizeIsbn(isbn)
+        return isbnTag["content"]
     return None
 
 
+def storeIsbn(url: str, isbn: Optional[str]) -> Optional[str]:
+    if isbn is None or isbn in ["000-00-0000-00-0"]:
+        return None
+    isbnCache[url] = normalizeIsbn(isbn)
+    return isbnCache[url]
+
+
+async def getBookIsbn(url: str) -> Optional[str]:
+    if url in isbnCache:
+        return isbnCache[url]
+    content = bytearray()
+    async with streamRequest("GET", url) as response:
+        if response.status_code == httpx.codes.NOT_FOUND:
+            return None
+        if response.is_success:
+            async for chunk in response.aiter_bytes():
+                start = max(0, len(content) - isbnMetaMaxLength)
+                content += chunk
+                isbn = findIsbnMeta(content, start)
+                if isbn is not None:
+                    return storeIsbn(url, isbn)
+    if not response.is_success:
+        if shouldRetry("GET", response):
+            await asyncio.sleep(retryDelay(response, 0))
+        response = await sendRequest("GET", url)
+        if response.status_code == httpx.codes.NOT_FOUND:
+            return None
+        response.raise_for_status()
+        content = response.content
+        isbn = findIsbnMeta(content)
+        if isbn is not None:
+            return storeIsbn(url, isbn)
+    isbn = await asyncio.to_thread(parseIsbnMeta, bytes(content))
+    return storeIsbn(url, isbn)
+
+
+async def addMissingIsbns(books, desc: str):
+    booksByUrl = {}
+    for book in books:
+        if book.isbn is not None:
+            continue
+        if book.url in isbnCache:
+            book.isbn = isbnCache[book.url]
+        else:
+            booksByUrl.setdefault(book.url, []).append(book)
+    lastFlush = time.monotonic()
+
+    async def _addMissingIsbn(url: str):
+        nonlocal lastFlush
+        isbn = await getBookIsbn(url)
+        for book in booksByUrl[url]:
+            book.isbn = isbn
+        if time.monotonic() - lastFlush >= isbnCacheFlushSeconds:
+            lastFlush = time.monotonic()
+            saveIsbnCache()
+
+    await gatherBounded(_addMissingIsbn, list(booksByUrl), desc=desc)
+
+
 def sortBooksByIsbn(books):
     return sorted(books, key=lambda book: "" if book.isbn is None else book.isbn)
+
+
+def writeBooks(outputJson: Path, books, pretty: bool):
+    books = sortBooksByIsbn(books)
+    partialJson = outputJson.with_suffix(".json.part")
+    with partialJson.open("wb") as f:
+        if pretty:
+            f.write(orjson.dumps(books, option=orjson.OPT_INDENT_2))
+        else:
+            f.write(b"[")
+            for index, book in enumerate(books):
+                if index > 0:
+                    f.write(b",")
+                f.write(orjson.dumps(book))
+            f.write(b"]")
+    os.replace(partialJson, outputJson)
+
+
+async def gatherBounded(
+    function: Callable[[T], Awaitable[None]],
+    items: Iterable[T],
+    desc: Optional[str] = None,
+    workers: int = maxWorkers,
+):
+    queue: asyncio.Queue = asyncio.Queue(maxsize=workers)
+    done = object()
+    progress = tqdm(total=len(items) if isinstance(items, Sized) else None, desc=desc)
+
+    async def _produce():
+        for item in items:
+            await queue.put(item)
+        for _ in range(workers):
+            await queue.put(done)
+
+    async def _worker():
+        while (item := await queue.get()) is not done:
+            await function(item)
+            progress.update()
+
+    try:
+        async with asyncio.TaskGroup() as taskGroup:
+            taskGroup.create_task(_produce())
+            for _ in range(workers):
+                taskGroup.create_task(_worker())
+    except BaseExceptionGroup as group:
+        raise group.exceptions[0]
+    finally:
+        progress.close()
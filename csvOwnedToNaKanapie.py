@@ -3,43 +3,61 @@ import asyncio
 import csv
 from pathlib import Path
 
-from tqdm.asyncio import tqdm
-
+from common import gatherBounded, normalizeIsbn
 from nakanapie import (
     logInToNaKanapie,
     readNaKanapie,
     updateNaKanapieBookStatus,
     KIND_WANT_TO_READ,
     downloadNaKanapie,
+    saveNaKanapie,
 )
 from importLubimyCzytacToNaKanapie import addMissingBook
 
 
 async def csvOwnedToNaKanapie(
-    csvFile: Path, usernameNaKanapie: str, output: Path, ownListId: int
+    csvFile: Path,
+    usernameNaKanapie: str,
+    output: Path,
+    ownListId: int,
+    verify: bool = False,
+    pretty: bool = False,
 ):
-    dictReader = csv.DictReader(csvFile.open("r"))
-    isbnColumn = next(
-        filter(lambda column: "isbn" in column.lower(), dictReader.fieldnames)
-    )
-    books = {book.isbn: book for book in readNaKanapie(output)}
+    naKanapieBooks = readNaKanapie(output)
+    books = {book.isbn: book for book in naKanapieBooks}
     missingNaKanapieIsbns = []
-    isbnsToProcess = []
-    for row in dictReader:
-        isbnsToProcess.append(row[isbnColumn])
+    addedNaKanapieIsbns = []
+
+    def _readIsbns():
+        seen = set()
+        with csvFile.open("r") as f:
+            dictReader = csv.DictReader(f)
+            isbnColumn = next(
+                filter(lambda column: "isbn" in column.lower(), dictReader.fieldnames)
+            )
+            for row in dictReader:
+                isbn = normalizeIsbn(row[isbnColumn] or "")
+                if len(isbn) > 0 and isbn not in seen:
+                    seen.add(isbn)
+                    yield isbn
 
     async def processIsbn(isbn: str):
         if isbn not in books:
-            await addMissingBook(isbn, KIND_WANT_TO_READ, missingNaKanapieIsbns)
+            await addMissingBook(
+                isbn, KIND_WANT_TO_READ, missingNaKanapieIsbns, addedNaKanapieIsbns
+            )
         else:
             book = books[isbn]
             if ownListId not in book.lists:
                 book.lists.append(ownListId)
                 await updateNaKanapieBookStatus(book)
 
-    await tqdm.gather(*[processIsbn(isbn) for isbn in isbnsToProcess])
+    await gatherBounded(processIsbn, _readIsbns())
     print("missingNaKanapieIsbns", missingNaKanapieIsbns)
-    await downloadNaKanapie(output, usernameNaKanapie)
+    if verify or len(addedNaKanapieIsbns) > 0:
+        await downloadNaKanapie(output, usernameNaKanapie, pretty)
+    else:
+        saveNaKanapie(output, naKanapieBooks, pretty)
 
 
 async def main():
@@ -62,6 +80,16 @@ async def main():
         required=False,
         default=Path("."),
     )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Whether to download books info from NaKanapie again after syncing",
+    )
+    parser.add_argument(
+        "--pretty",
+        action="store_true",
+        help="Whether to indent the output JSON",
+    )
     args = parser.parse_args()
     await logInToNaKanapie(
         userLogin=args.loginNaKanapie, userPassword=args.passwordNaKanapie
@@ -71,6 +99,8 @@ async def main():
         usernameNaKanapie=args.usernameNaKanapie,
         output=args.output,
         ownListId=args.ownListId,
+        verify=args.verify,
+        pretty=args.pretty,
     )
 
 
@@ -3,8 +3,7 @@ import asyncio
 from pathlib import Path
 from typing import Optional
 
-from tqdm.asyncio import tqdm
-
+from common import gatherBounded, warmUpConnections
 from lubimyczytac import (
     readLubimyCzytac,
     downloadLubimyCzytac,
@@ -13,6 +12,7 @@ from lubimyczytac import (
     SHELF_READ,
     SHELF_WANT_TO_READ,
     SHELF_OWN,
+    lubimyCzytacDomain,
 )
 from nakanapie import (
     readNaKanapie,
@@ -48,30 +48,37 @@ ignoredShelves = set()
 
 
 def bookNeedsUpdate(
-    lubimyCzytacBook: LubimyCzytacBook, naKanapieBook: NaKanapieBook
+    lubimyCzytacBook: LubimyCzytacBook,
+    naKanapieBook: NaKanapieBook,
+    newKind: Optional[str],
 ) -> Optional[NaKanapieBook]:
-    newKind = findKindForBook(lubimyCzytacBook)
+    lists = set(naKanapieBook.lists)
     newLists = []
     for shelf in lubimyCzytacBook.shelves:
         if shelf in LUBIMYCZYTAC_TO_NAKANAPIE:
             naKanapieExpected = LUBIMYCZYTAC_TO_NAKANAPIE[shelf]
             if isinstance(naKanapieExpected, int):
-                if naKanapieExpected not in naKanapieBook.lists:
+                if naKanapieExpected not in lists:
+                    lists.add(naKanapieExpected)
                     newLists.append(naKanapieExpected)
         elif shelf not in ignoredShelves:
             ignoredShelves.add(shelf)
             print(f"Unknown LubimyCzytac shelf: {shelf}. Ignoring")
-    if newKind is not None or len(newLists) > 0:
-        naKanapieBook.kind = newKind
+    kindChanged = newKind is not None and newKind != naKanapieBook.kind
+    if kindChanged or len(newLists) > 0:
+        if kindChanged:
+            naKanapieBook.kind = newKind
         naKanapieBook.lists.extend(newLists)
         return naKanapieBook
     return None
 
 
 async def syncSharedBook(
-    lubimyCzytacBook: LubimyCzytacBook, naKanapieBook: NaKanapieBook
+    lubimyCzytacBook: LubimyCzytacBook,
+    naKanapieBook: NaKanapieBook,
+    newKind: Optional[str],
 ):
-    updateBook = bookNeedsUpdate(lubimyCzytacBook, naKanapieBook)
+    updateBook = bookNeedsUpdate(lubimyCzytacBook, naKanapieBook, newKind)
     if updateBook is not None:
         await updateNaKanapieBookStatus(updateBook)
 
@@ -79,18 +86,23 @@ async def syncSharedBook(
 async def syncSharedBooks(
     lubimyCzytacIsbnToBook: dict[str, LubimyCzytacBook],
     naKanapieIsbnToBook: dict[str, NaKanapieBook],
+    kindByIsbn: dict[str, Optional[str]],
 ):
-    sharedIsbns = set(lubimyCzytacIsbnToBook.keys()) & set(naKanapieIsbnToBook.keys())
-    await tqdm.gather(
-        *[
-            syncSharedBook(lubimyCzytacIsbnToBook[isbn], naKanapieIsbnToBook[isbn])
-            for isbn in sharedIsbns
-        ],
-        desc="↔️ Syncing shared books",
-    )
+    sharedIsbns = [
+        isbn for isbn in lubimyCzytacIsbnToBook if isbn in naKanapieIsbnToBook
+    ]
+
+    async def _syncSharedIsbn(isbn: str):
+        await syncSharedBook(
+            lubimyCzytacIsbnToBook[isbn], naKanapieIsbnToBook[isbn], kindByIsbn[isbn]
+        )
+
+    await gatherBounded(_syncSharedIsbn, sharedIsbns, desc="↔️ Syncing shared books")
 
 
-async def addMissingBook(isbn: str, kind: str, isbnsNotFound: list[str]):
+async def addMissingBook(
+    isbn: str, kind: str, isbnsNotFound: list[str], isbnsAdded: list[str]
+):
     searchResult = await searchNaKanapieBook(isbn)
     if searchResult is not None:
         try:
@@ -99,6 +111,7 @@ async def addMissingBook(isbn: str, kind: str, isbnsNotFound: list[str]):
                 bundleId=searchResult.bundleId,
                 kind=kind,
             )
+            isbnsAdded.append(isbn)
         except Exception as e:
             print(f"Failed to add book with isbn {isbn}: {e}")
     else:
@@ -108,21 +121,23 @@ async def addMissingBook(isbn: str, kind: str, isbnsNotFound: list[str]):
 async def addMissingBooks(
     lubimyCzytacIsbnToBook: dict[str, LubimyCzytacBook],
     naKanapieIsbnToBook: dict[str, NaKanapieBook],
-):
-    missingIsbns = set(lubimyCzytacIsbnToBook.keys()) - set(naKanapieIsbnToBook.keys())
+    kindByIsbn: dict[str, Optional[str]],
+) -> list[str]:
+    missingIsbns = [
+        isbn for isbn in lubimyCzytacIsbnToBook if isbn not in naKanapieIsbnToBook
+    ]
     isbnsNotFound = []
+    isbnsAdded = []
 
-    await tqdm.gather(
-        *[
-            addMissingBook(
-                isbn, findKindForBook(lubimyCzytacIsbnToBook[isbn]), isbnsNotFound
-            )
-            for isbn in missingIsbns
-        ],
-        desc="🛋️ NaKanapie: Adding missing books",
+    async def _addMissingIsbn(isbn: str):
+        await addMissingBook(isbn, kindByIsbn[isbn], isbnsNotFound, isbnsAdded)
+
+    await gatherBounded(
+        _addMissingIsbn, missingIsbns, desc="🛋️ NaKanapie: Adding missing books"
     )
 
     print(f"Books not found on NaKanapie: {isbnsNotFound}")
+    return isbnsAdded
 
 
 async def importLubimyCzytacToNaKanapie(
@@ -133,26 +148,40 @@ async def importLubimyCzytacToNaKanapie(
     ownListId: Optional[int],
     loginNaKanapie: str,
     passwordNaKanapie: str,
+    verify: bool = False,
+    pretty: bool = False,
 ):
-    await logInToNaKanapie(userLogin=loginNaKanapie, userPassword=passwordNaKanapie)
+    await asyncio.gather(
+        logInToNaKanapie(userLogin=loginNaKanapie, userPassword=passwordNaKanapie),
+        warmUpConnections(lubimyCzytacDomain),
+    )
     if ownListId is not None:
         LUBIMYCZYTAC_TO_NAKANAPIE[SHELF_OWN] = ownListId
     lubimyCzytacBooks = readLubimyCzytac(output)
     naKanapieBooks = readNaKanapie(output)
     if forceDownload or len(lubimyCzytacBooks) == 0:
-        lubimyCzytacBooks = await downloadLubimyCzytac(output, profileIdLubimyCzytac)
+        lubimyCzytacBooks = await downloadLubimyCzytac(
+            output, profileIdLubimyCzytac, pretty
+        )
     if forceDownload or len(naKanapieBooks) == 0:
-        naKanapieBooks = await downloadNaKanapie(output, usernameNaKanapie)
+        naKanapieBooks = await downloadNaKanapie(output, usernameNaKanapie, pretty)
     lubimyCzytacIsbnToBook = {
         book.isbn: book for book in lubimyCzytacBooks if book.isbn is not None
     }
     naKanapieIsbnToBook = {
         book.isbn: book for book in naKanapieBooks if book.isbn is not None
     }
-    await syncSharedBooks(lubimyCzytacIsbnToBook, naKanapieIsbnToBook)
-    await addMissingBooks(lubimyCzytacIsbnToBook, naKanapieIsbnToBook)
-    saveNaKanapie(output, naKanapieBooks)
-    await downloadNaKanapie(output, usernameNaKanapie)
+    kindByIsbn = {
+        isbn: findKindForBook(book) for isbn, book in lubimyCzytacIsbnToBook.items()
+    }
+    await syncSharedBooks(lubimyCzytacIsbnToBook, naKanapieIsbnToBook, kindByIsbn)
+    isbnsAdded = await addMissingBooks(
+        lubimyCzytacIsbnToBook, naKanapieIsbnToBook, kindByIsbn
+    )
+    if verify or len(isbnsAdded) > 0:
+        await downloadNaKanapie(output, usernameNaKanapie, pretty)
+    else:
+        saveNaKanapie(output, naKanapieBooks, pretty)
 
 
 async def main():
@@ -186,6 +215,16 @@ async def main():
         required=False,
         default=None,
     )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Whether to download books info from NaKanapie again after syncing",
+    )
+    parser.add_argument(
+        "--pretty",
+        action="store_true",
+        help="Whether to indent the output JSON",
+    )
     args = parser.parse_args()
     await importLubimyCzytacToNaKanapie(
         profileIdLubimyCzytac=args.profileIdLubimyCzytac,
@@ -195,6 +234,8 @@ async def main():
         output=args.output,
         forceDownload=args.forceDownload,
         ownListId=args.ownListId,
+        verify=args.verify,
+        pretty=args.pretty,
     )
 
 
@@ -1,31 +1,70 @@
 import argparse
 import asyncio
-from dataclasses import dataclass
+import os
+from dataclasses import MISSING, dataclass, fields
+from operator import itemgetter
 from pathlib import Path
 from typing import Optional
 
+import aiofiles
 import httpx
 import orjson
-from bs4 import BeautifulSoup
+from lxml import etree, html
 import re
 
 from tqdm.asyncio import tqdm
-from common import httpxClient, normalizeIsbn, getBookIsbn, sortBooksByIsbn
+from common import (
+    sendRequest,
+    normalizeIsbn,
+    addMissingIsbns,
+    writeBooks,
+    gatherBounded,
+    streamRequest,
+    loadIsbnCache,
+)
 
 bookUrlPattern = re.compile(r"/ksiazka/(\d+)")
 authorUrlPattern = re.compile(r"/autor/(\d+)")
 bookCycleUrlPattern = re.compile(r"/cykl/(\d+)")
 shelvesUrlPattern = re.compile(r"/biblioteczka/lista\?shelfs=(\d+)")
 
+regexNamespaces = {"re": "http://exslt.org/regular-expressions"}
+
+
+def classXPath(tag: str, className: str) -> str:
+    return (
+        f"{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {className} ')]"
+    )
+
+
+def linkXPath(pattern: re.Pattern) -> etree.XPath:
+    return etree.XPath(
+        f".//a[re:test(@href, '{pattern.pattern}')]", namespaces=regexNamespaces
+    )
+
+
+coverSelector = ".//" + classXPath("img", "img-fluid") + "/@data-src"
+rowXPath = etree.XPath(
+    "//" + classXPath("div", "row") + f"[count(node()) > 1][{coverSelector}]"
+)
+coverUrlXPath = etree.XPath(coverSelector, smart_strings=False)
+bookLinkXPath = linkXPath(bookUrlPattern)
+authorLinkXPath = linkXPath(authorUrlPattern)
+cycleLinkXPath = linkXPath(bookCycleUrlPattern)
+shelvesLinksXPath = linkXPath(shelvesUrlPattern)
+
 lubimyCzytacDomain = "https://lubimyczytac.pl"
 
+maxCoverDownloads = 20
+coverChunkSize = 65536
+
 SHELF_READ = "Przeczytane"
 SHELF_OWN = "Posiadam"
 SHELF_WANT_TO_READ = "Chcę przeczytać"
 SHELF_READING = "Teraz czytam"
 
 
-@dataclass
+@dataclass(slots=True)
 class LubimyCzytacBook:
     coverUrl: str
     url: str
@@ -36,24 +75,61 @@ class LubimyCzytacBook:
     cycleUrl: Optional[str]
     shelves: list[str]
     isbn: Optional[str]
+    bookId: Optional[str] = None
+
+    def __post_init__(self):
+        if self.bookId is None:
+            self.bookId = bookUrlPattern.search(self.url).group(1)
 
-    @property
-    def bookId(self) -> str:
-        return bookUrlPattern.search(self.url).group(1)
 
+lubimyCzytacBookFields = itemgetter(
+    *(field.name for field in fields(LubimyCzytacBook) if field.default is MISSING)
+)
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class LubimyCzytacBooksPageResponse:
     books: list[LubimyCzytacBook]
     count: int
     left: int
 
 
+def parseBooks(content: str, bookIdToIsbn: dict[str, str]) -> list[LubimyCzytacBook]:
+    rows = rowXPath(html.fromstring(content)) if content.strip() else []
+    books = []
+    for row in rows:
+        bookLink = bookLinkXPath(row)[0]
+        bookHref = bookLink.get("href")
+        bookId = bookUrlPattern.search(bookHref).group(1)
+        authorLink = authorLinkXPath(row)[0]
+        cycleLinks = cycleLinkXPath(row)
+        cycleLink = cycleLinks[0] if len(cycleLinks) > 0 else None
+        shelvesLinks = shelvesLinksXPath(row)
+        book = LubimyCzytacBook(
+            coverUrl=coverUrlXPath(row)[0],
+            url=lubimyCzytacDomain + bookHref
+            if lubimyCzytacDomain not in bookHref
+            else bookHref,
+            title=bookLink.text_content().strip(),
+            author=authorLink.text_content().strip(),
+            authorUrl=authorLink.get("href"),
+            cycle=cycleLink.text_content().strip() if cycleLink is not None else None,
+            cycleUrl=cycleLink.get("href") if cycleLink is not None else None,
+            shelves=[a.text_content().strip() for a in shelvesLinks],
+            isbn=bookIdToIsbn.get(bookId),
+            bookId=bookId,
+        )
+        books.append(book)
+    return books
+
+
 async def getBooksPage(
     page: int, profileId: int, bookIdToIsbn: dict[str, str]
 ) -> Optional[LubimyCzytacBooksPageResponse]:
-    response = await httpxClient.post(
+    response = await sendRequest(
+        "POST",
         "https://lubimyczytac.pl/profile/getLibraryBooksList",
+        follow_redirects=False,
         headers={
             "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
             "X-Requested-With": "XMLHttpRequest",
@@ -71,35 +147,8 @@ async def getBooksPage(
     if response.status_code == httpx.codes.NOT_FOUND:
         return None
     response.raise_for_status()
-    data = response.json()["data"]
-    soup = BeautifulSoup(data["content"], "html.parser")
-    books = []
-    for row in soup.select("div.row"):
-        if len(list(row.children)) <= 1:
-            continue
-        cover = row.select("img.img-fluid")
-        if len(cover) == 0:
-            continue
-        bookLink = row.find("a", {"href": bookUrlPattern})
-        authorLink = row.find("a", {"href": authorUrlPattern})
-        cycleLink = row.find("a", {"href": bookCycleUrlPattern})
-        shelvesLinks = row.find_all("a", {"href": shelvesUrlPattern})
-        book = LubimyCzytacBook(
-            coverUrl=cover[0]["data-src"],
-            url=lubimyCzytacDomain + bookLink["href"]
-            if lubimyCzytacDomain not in bookLink["href"]
-            else bookLink["href"],
-            title=bookLink.text.strip(),
-            author=authorLink.text.strip(),
-            authorUrl=authorLink["href"],
-            cycle=cycleLink.text.strip() if cycleLink is not None else None,
-            cycleUrl=cycleLink["href"] if cycleLink is not None else None,
-            shelves=[a.text.strip() for a in shelvesLinks],
-            isbn=None,
-        )
-        if book.bookId in bookIdToIsbn:
-            book.isbn = bookIdToIsbn[book.bookId]
-        books.append(book)
+    data = orjson.loads(response.content)["data"]
+    books = parseBooks(data["content"], bookIdToIsbn)
     return LubimyCzytacBooksPageResponse(
         books=books,
         count=int(data["count"]),
@@ -116,48 +165,47 @@ async def getBooks(
         if book.isbn is not None
     }
     firstPage = await getBooksPage(1, profileId, bookIdToIsbn)
+    if firstPage is None or len(firstPage.books) == 0:
+        return []
     books = firstPage.books
-
-    async def _processPage(page: int):
-        pageBooks = await getBooksPage(page, profileId, bookIdToIsbn)
-        if pageBooks is None or len(pageBooks.books) == 0:
-            return
-        books.extend(pageBooks.books)
-        page += 1
-
-    await tqdm.gather(
+    for booksPage in await tqdm.gather(
         *[
-            _processPage(page)
+            getBooksPage(page, profileId, bookIdToIsbn)
             for page in range(2, firstPage.count // len(firstPage.books) + 2)
         ],
         desc="📖 LubimyCzytac: Downloading books",
-    )
+    ):
+        if booksPage is not None:
+            books.extend(booksPage.books)
 
-    async def _addMissingIsbn(book: LubimyCzytacBook):
-        book.isbn = await getBookIsbn(book.url)
-
-    await tqdm.gather(
-        *[_addMissingIsbn(book) for book in books if book.isbn is None],
-        desc="📖 LubimyCzytac: Adding missing ISBNs",
-    )
+    await addMissingIsbns(books, desc="📖 LubimyCzytac: Adding missing ISBNs")
     return books
 
 
 async def downloadCovers(books: list[LubimyCzytacBook], coversDir: Path):
     coversDir.mkdir(exist_ok=True)
+    existingCovers = frozenset(path.name for path in coversDir.iterdir())
+    missingCovers = {
+        book.bookId: book
+        for book in books
+        if f"{book.bookId}.jpg" not in existingCovers
+    }
 
     async def _downloadCover(book: LubimyCzytacBook):
         coverPath = coversDir / f"{book.bookId}.jpg"
-        if coverPath.exists():
-            return
-        response = await httpxClient.get(book.coverUrl)
-        response.raise_for_status()
-        with coverPath.open("wb") as f:
-            f.write(response.content)
-
-    await tqdm.gather(
-        *[_downloadCover(book) for book in books],
+        partialPath = coverPath.with_suffix(".jpg.part")
+        async with streamRequest("GET", book.coverUrl) as response:
+            response.raise_for_status()
+            async with aiofiles.open(partialPath, "wb") as f:
+                async for chunk in response.aiter_bytes(coverChunkSize):
+                    await f.write(chunk)
+        os.replace(partialPath, coverPath)
+
+    await gatherBounded(
+        _downloadCover,
+        list(missingCovers.values()),
         desc="📖 LubimyCzytac: Downloading covers",
+        workers=maxCoverDownloads,
     )
 
 
@@ -166,19 +214,23 @@ def readLubimyCzytac(outputDirectory: Path) -> list[LubimyCzytacBook]:
     result: list[LubimyCzytacBook] = []
     if outputJson.exists():
         with outputJson.open("rb") as f:
-            result = [LubimyCzytacBook(**book) for book in orjson.loads(f.read())]
+            result = [
+                LubimyCzytacBook(
+                    *lubimyCzytacBookFields(book), bookId=book.get("bookId")
+                )
+                for book in orjson.loads(f.read())
+            ]
     return result
 
 
 async def downloadLubimyCzytac(
-    outputDirectory: Path, profileId: int
+    outputDirectory: Path, profileId: int, pretty: bool = False
 ) -> list[LubimyCzytacBook]:
+    loadIsbnCache(outputDirectory)
     outputJson = outputDirectory / "lubimyczytac.json"
     previousResult = readLubimyCzytac(outputDirectory)
     booksFetched = await getBooks(profileId, previousResult)
-    outputJson.write_bytes(
-        orjson.dumps(sortBooksByIsbn(booksFetched), option=orjson.OPT_INDENT_2)
-    )
+    writeBooks(outputJson, booksFetched, pretty)
     await downloadCovers(booksFetched, outputDirectory / "covers")
     return booksFetched
 
@@ -195,8 +247,15 @@ async def main():
         required=False,
         default=Path("."),
     )
+    parser.add_argument(
+        "--pretty",
+        action="store_true",
+        help="Whether to indent the output JSON",
+    )
     args = parser.parse_args()
-    await downloadLubimyCzytac(outputDirectory=args.output, profileId=args.profileId)
+    await downloadLubimyCzytac(
+        outputDirectory=args.output, profileId=args.profileId, pretty=args.pretty
+    )
 
 
 if __name__ == "__main__":
@@ -1,15 +1,22 @@
 import argparse
 import asyncio
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from operator import itemgetter
 from pathlib import Path
 from typing import Optional
 
 import orjson
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from tqdm.asyncio import tqdm
 
-from common import httpxClient, normalizeIsbn, getBookIsbn, sortBooksByIsbn
+from common import (
+    sendRequest,
+    normalizeIsbn,
+    addMissingIsbns,
+    writeBooks,
+    loadIsbnCache,
+)
 
 naKanapieDomain = "https://nakanapie.pl"
 
@@ -18,13 +25,18 @@ KIND_READING = "currently_reading"
 KIND_READ = "have_read"
 KIND_WANT_TO_READ = "want_to_read"
 
+bookFields = itemgetter(
+    "id", "bundle_id", "book_id", "title", "authors", "kind", "book", "lists"
+)
+
 bundlePattern = re.compile(r"bundle_(\d+)")
-bookLinkPattern = re.compile(r"/ksiazka/.*\?.*")
+bookLinkSelector = 'a[href*="/ksiazka/"][href*="?"]'
+bundleSelector = 'div[id^="bundle_"]'
 bookIdPattern = re.compile(r"/ksiazka/.*-(\d{6,})\?")
 reviewBookIdPattern = re.compile(r"/dodaj\?ksiazka=(\d{6,})\"")
 
 
-@dataclass
+@dataclass(slots=True)
 class NaKanapieBook:
     id: int
     bundleId: int
@@ -37,7 +49,10 @@ class NaKanapieBook:
     lists: list[int]
 
 
-@dataclass
+naKanapieBookFields = itemgetter(*(field.name for field in fields(NaKanapieBook)))
+
+
+@dataclass(slots=True, frozen=True)
 class NaKanapieBooksPageResponse:
     books: list[NaKanapieBook]
     count: int
@@ -47,8 +62,10 @@ class NaKanapieBooksPageResponse:
 async def getBooksPage(
     username: str, page: int, bookIdToIsbn: dict[int, str]
 ) -> NaKanapieBooksPageResponse:
-    response = await httpxClient.post(
-        url=f"https://nakanapie.pl/{username}/ksiazki/szukaj",
+    response = await sendRequest(
+        "POST",
+        f"https://nakanapie.pl/{username}/ksiazki/szukaj",
+        follow_redirects=False,
         json={
             "selectedLists": [],
             "selectedYears": [],
@@ -62,24 +79,28 @@ async def getBooksPage(
         },
     )
     response.raise_for_status()
-    data = response.json()
-    return NaKanapieBooksPageResponse(
-        books=[
+    data = orjson.loads(response.content)
+    books = []
+    for book in data["books"]:
+        relationId, bundleId, bookId, title, authors, kind, bookInfo, lists = (
+            bookFields(book)
+        )
+        url = bookInfo["url"]
+        books.append(
             NaKanapieBook(
-                id=book["id"],
-                bundleId=book["bundle_id"],
-                bookId=book["book_id"],
-                title=book["title"],
-                authors=book["authors"],
-                kind=book["kind"],
-                url=book["book"]["url"]
-                if naKanapieDomain in book["book"]["url"]
-                else naKanapieDomain + book["book"]["url"],
-                isbn=bookIdToIsbn.get(book["id"], None),
-                lists=book["lists"],
+                id=relationId,
+                bundleId=bundleId,
+                bookId=bookId,
+                title=title,
+                authors=authors,
+                kind=kind,
+                url=url if naKanapieDomain in url else naKanapieDomain + url,
+                isbn=bookIdToIsbn.get(relationId, None),
+                lists=lists,
             )
-            for book in data["books"]
-        ],
+        )
+    return NaKanapieBooksPageResponse(
+        books=books,
         count=data["pagination"]["count"],
         pages=data["pagination"]["pages"],
     )
@@ -111,38 +132,37 @@ def readNaKanapie(outputDirectory: Path) -> list[NaKanapieBook]:
     result: list[NaKanapieBook] = []
     if outputJson.exists():
         with outputJson.open("rb") as f:
-            result = [NaKanapieBook(**book) for book in orjson.loads(f.read())]
+            result = [
+                NaKanapieBook(*naKanapieBookFields(book))
+                for book in orjson.loads(f.read())
+            ]
     return result
 
 
-def saveNaKanapie(outputDirectory: Path, books: list[NaKanapieBook]):
-    outputJson = outputDirectory / "nakanapie.json"
-    outputJson.write_bytes(
-        orjson.dumps(sortBooksByIsbn(books), option=orjson.OPT_INDENT_2)
-    )
+def saveNaKanapie(
+    outputDirectory: Path, books: list[NaKanapieBook], pretty: bool = False
+):
+    writeBooks(outputDirectory / "nakanapie.json", books, pretty)
 
 
 async def downloadNaKanapie(
-    outputDirectory: Path, username: str
+    outputDirectory: Path, username: str, pretty: bool = False
 ) -> list[NaKanapieBook]:
+    loadIsbnCache(outputDirectory)
     previousResult = readNaKanapie(outputDirectory)
     books = await getBooks(username, previousResult)
 
-    async def _addMissingIsbn(book: NaKanapieBook):
-        book.isbn = await getBookIsbn(book.url)
-
-    await tqdm.gather(
-        *[_addMissingIsbn(book) for book in books if book.isbn is None],
-        desc="🛋️ NaKanapie: Adding missing ISBNs",
-    )
+    await addMissingIsbns(books, desc="🛋️ NaKanapie: Adding missing ISBNs")
 
-    saveNaKanapie(outputDirectory, books)
+    saveNaKanapie(outputDirectory, books, pretty)
     return books
 
 
 async def addNaKanapieBook(bookId: int, bundleId: int, kind: str):
-    response = await httpxClient.post(
+    response = await sendRequest(
+        "POST",
         "https://nakanapie.pl/api/v1/book/status",
+        follow_redirects=False,
         json={
             "book": bookId,
             "bundle": bundleId,
@@ -153,9 +173,9 @@ async def addNaKanapieBook(bookId: int, bundleId: int, kind: str):
 
 
 async def updateNaKanapieBookStatus(book: NaKanapieBook):
-    response = await httpxClient.put(
+    response = await sendRequest(
+        "PUT",
         f"https://nakanapie.pl/profil/relations/{book.id}",
-        follow_redirects=True,
         json={
             "book_id": book.bookId,
             "favorite": False,
@@ -169,26 +189,26 @@ async def updateNaKanapieBookStatus(book: NaKanapieBook):
     response.raise_for_status()
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class SearchResult:
     bundleId: int
     bookId: int
 
 
 async def searchNaKanapieBook(isbn: str) -> Optional[SearchResult]:
-    response = await httpxClient.get(f"https://nakanapie.pl/search/instant?q={isbn}")
+    response = await sendRequest("GET", f"https://nakanapie.pl/search/instant?q={isbn}")
     response.raise_for_status()
     if "Nie znaleziono żadnych wyników" in response.text:
         return None
-    soup = BeautifulSoup(response.text, "html.parser")
-    bookLink = soup.find("a", {"href": bookLinkPattern})
+    tree = LexborHTMLParser(response.text)
+    bookLink = tree.css_first(bookLinkSelector)
     if bookLink is None:
         return None
-    bookUrl = bookLink["href"]
+    bookUrl = bookLink.attributes["href"]
     searchBookId = bookIdPattern.search(bookUrl)
     bookId = None
     if searchBookId is None:
-        bookResponse = await httpxClient.get(naKanapieDomain + bookUrl)
+        bookResponse = await sendRequest("GET", naKanapieDomain + bookUrl)
         reviewBookId = reviewBookIdPattern.search(bookResponse.text)
         if reviewBookId is not None:
             bookId = int(reviewBookId.group(1))
@@ -196,10 +216,13 @@ async def searchNaKanapieBook(isbn: str) -> Optional[SearchResult]:
         bookId = int(bookIdPattern.search(bookUrl).group(1))
     if bookId is None:
         return None
-    bundleIdLink = soup.find("div", {"id": bundlePattern})
+    bundleIdLink = tree.css_first(bundleSelector)
     if bundleIdLink is None:
         return None
-    bundleId = int(bundlePattern.search(bundleIdLink["id"]).group(1))
+    searchBundleId = bundlePattern.search(bundleIdLink.attributes["id"])
+    if searchBundleId is None:
+        return None
+    bundleId = int(searchBundleId.group(1))
     return SearchResult(
         bundleId=bundleId,
         bookId=bookId,
@@ -207,9 +230,9 @@ async def searchNaKanapieBook(isbn: str) -> Optional[SearchResult]:
 
 
 async def logInToNaKanapie(userLogin, userPassword):
-    response = await httpxClient.post(
+    response = await sendRequest(
+        "POST",
         "https://nakanapie.pl/konto/logowanie",
-        follow_redirects=True,
         data={
             "user[login]": userLogin,
             "user[password]": userPassword,
@@ -231,8 +254,15 @@ async def main():
         required=False,
         default=Path("."),
     )
+    parser.add_argument(
+        "--pretty",
+        action="store_true",
+        help="Whether to indent the output JSON",
+    )
     args = parser.parse_args()
-    await downloadNaKanapie(outputDirectory=args.output, username=args.username)
+    await downloadNaKanapie(
+        outputDirectory=args.output, username=args.username, pretty=args.pretty
+    )
 
 
 if __name__ == "__main__":